@@ -18,8 +18,11 @@ __appname__ = "JSON Data Transformation Helper"
 __version__ = "0.1"
 __license__ = "MIT"
 
-import csv, json, logging, sys
-from itertools import chain, groupby
+import csv, heapq, json, logging, mmap, numbers, os, re, struct, sys
+import tempfile, time, unicodedata
+from bisect import bisect_right
+from collections import Counter
+from itertools import chain, groupby, islice
 
 log = logging.getLogger(__name__)
 
@@ -50,8 +53,132 @@ def group_by_multiple(records, field_names, render_inner=lambda x: list(x),
             yield key, dict(group_by_multiple(group, field_names[1:],
                             render_inner, list_ordering=list_ordering))
 
-def make_graph(records, label_field):
+def sort_key(field_names):
+    """Build a sort key for a composite of fields which tolerates C{None}
+
+    (C{None} sorts before any other value in the same field.)
+    """
+    return lambda rec: tuple((rec[x] is not None, rec[x])
+                             for x in field_names)
+
+def record_sort_key(field_names):
+    """Like L{sort_key}, but break ties by C{id} so the ordering of records
+    doesn't depend on the order they were read in.
+
+    (This lets L{apply_changeset} reproduce a full rebuild exactly.)
+    """
+    if 'id' not in field_names:
+        field_names = list(field_names) + ['id']
+    return sort_key(field_names)
+
+def iter_records(file_obj):
+    """Read records from either a JSON list or a JSON Lines file.
+
+    JSON Lines input is parsed one record at a time so it can be streamed.
+    """
+    for line in file_obj:
+        if line.strip():
+            break
+    else:
+        return
+
+    if line.lstrip().startswith('['):
+        for record in json.loads(line + file_obj.read()):
+            yield record
+    else:
+        yield json.loads(line)
+        for line in file_obj:
+            if line.strip():
+                yield json.loads(line)
+
+MERGE_WIDTH = 64
+
+def external_sort(records, key, max_in_memory=100000,
+                  merge_width=MERGE_WIDTH):
+    """Sort an iterable of records without holding it all in memory.
+
+    Sorted runs of up to C{max_in_memory} records are spilled to temporary
+    files as JSON Lines, then lazily merged. To bound the number of open
+    files, every C{merge_width} runs are merged into a single longer run as
+    they accumulate. The sort is stable.
+
+    @returns: A sorted list if the input fit in a single run, otherwise an
+        iterator over the sorted records.
+    """
+    end = object()
+    records = iter(records)
+    run = list(islice(records, max_in_memory))
+    run.sort(key=key)
+    lookahead = next(records, end)
+    if lookahead is end:
+        return run
+
+    # Tiers of runs, each in input order, with older input in higher tiers
+    tiers = [[]]
+    try:
+        while True:
+            tiers[0].append(_write_run(run))
+            run = None  # Free the run before reading the next one
+
+            for tier, tier_runs in enumerate(tiers):
+                if len(tier_runs) < merge_width:
+                    break
+                tiers[tier] = []
+                if tier + 1 == len(tiers):
+                    tiers.append([])
+                tiers[tier + 1].append(_write_run(
+                    _merge_runs(tier_runs, key)))
+
+            if lookahead is end:
+                break
+            run = list(islice(chain([lookahead], records), max_in_memory))
+            run.sort(key=key)
+            lookahead = next(records, end)
+
+        runs = list(chain.from_iterable(reversed(tiers)))
+        while len(runs) > merge_width:
+            runs = [_write_run(_merge_runs(runs[x:x + merge_width], key))
+                    for x in range(0, len(runs), merge_width)]
+    except:  # noqa
+        for run_file in chain.from_iterable(tiers):
+            run_file.close()
+        raise
+    log.debug("Merging %d sorted runs", len(runs))
+    return _merge_runs(runs, key)
+
+def _write_run(records):
+    """Spill records to a temporary JSON Lines file for L{external_sort}"""
+    run_file = tempfile.TemporaryFile(mode='w+')
+    try:
+        for record in records:
+            run_file.write(json.dumps(record) + '\n')
+        run_file.seek(0)
+    except:  # noqa
+        run_file.close()
+        raise
+    return run_file
+
+def _merge_runs(runs, key):
+    """Lazily merge (and then close) temporary files from L{external_sort}"""
+    def read_run(run_file, run_idx):
+        """Decorate a run's records for a stable merge"""
+        for offset, line in enumerate(run_file):
+            record = json.loads(line)
+            yield key(record), run_idx, offset, record
+
+    try:
+        for decorated in heapq.merge(*[read_run(x, idx)
+                                       for idx, x in enumerate(runs)]):
+            yield decorated[-1]
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+def make_graph(records, label_field, layout=False):
     """The core of the C{visjs} subcommand that's repeated with --multilevel"""
+    if layout:
+        layout_tree(records)
+
     edges = []
     for record in records:
         record['label'] = record[label_field]
@@ -68,6 +195,171 @@ def make_graph(records, label_field):
         'edges': edges
     }
 
+def build_tree(parent_ids):
+    """Build a parent->children index from a C{{id: parent_id}} mapping.
+
+    Records whose parent is C{None} or missing from the data set (orphans
+    from an incomplete dump) are treated as roots.
+
+    @returns: C{tuple(children, roots)} with child lists sorted by ID.
+    """
+    children, roots = {}, []
+    for node_id, parent_id in parent_ids.items():
+        if parent_id is None or parent_id not in parent_ids:
+            roots.append(node_id)
+        else:
+            children.setdefault(parent_id, []).append(node_id)
+
+    for child_list in children.values():
+        child_list.sort()
+    roots.sort()
+    return children, roots
+
+def walk_tree(children, roots):
+    """Iterative pre-order walk which is safe on arbitrarily deep chains.
+
+    @returns: A generator of C{(id, depth)} tuples, with roots at depth 0.
+    """
+    stack = [(root, 0) for root in reversed(roots)]
+    while stack:
+        node_id, depth = stack.pop()
+        yield node_id, depth
+        stack.extend((x, depth + 1)
+                     for x in reversed(children.get(node_id, ())))
+
+def layout_tree(records, level_separation=500, node_spacing=50):
+    """Assign deterministic left-to-right tree layout coordinates to records.
+
+    Each leaf gets its own row, each parent is centred on the span of its
+    children, and each connected component is stacked below the last,
+    so the result only depends on the IDs and C{parent_id} links.
+    """
+    parent_ids = dict((x['id'], x['parent_id']) for x in records)
+    children, roots = build_tree(parent_ids)
+
+    order, positions, row = [], {}, -1
+    for node_id, depth in walk_tree(children, roots):
+        order.append(node_id)
+        if not depth and len(order) > 1:
+            row += 1  # Leave a blank row between components
+        if node_id not in children:
+            row += 1
+            positions[node_id] = (depth * level_separation, row * node_spacing)
+
+    # Reverse pre-order visits every child before its parent
+    for node_id in reversed(order):
+        if node_id in children:
+            child_list = children[node_id]
+            top, bottom = (positions[child_list[0]][1],
+                           positions[child_list[-1]][1])
+            positions[node_id] = (positions[child_list[0]][0] -
+                                  level_separation, (top + bottom) / 2)
+
+    # Records in parent_id cycles are unreachable from any root, so give
+    # each one its own row at the bottom rather than leave it unpositioned
+    leftovers = sorted(x for x in parent_ids if x not in positions)
+    if leftovers:
+        log.warning("Laying out %d records which are part of parent_id "
+                    "cycles on their own rows", len(leftovers))
+        row += 1
+        for node_id in leftovers:
+            row += 1
+            positions[node_id] = (0, row * node_spacing)
+
+    for record in records:
+        record['x'], record['y'] = positions[record['id']]
+    return records
+
+def story_path(parents, leaf_id):
+    """Rebuild the root-to-leaf reading chain from C{paths} output in
+    O(depth) time.
+
+    @param parents: The C{parents} mapping from the C{paths} subcommand.
+        (String keys, as produced by a JSON round-trip, are accepted.)
+    @raises KeyError: C{leaf_id} (or one of its ancestors) isn't in
+        C{parents}.
+    """
+    if parents and not isinstance(next(iter(parents)), int):
+        as_key = lambda x: '%s' % x
+    else:
+        as_key = lambda x: x
+
+    if as_key(leaf_id) not in parents:
+        raise KeyError(leaf_id)
+
+    path, node_id = [], leaf_id
+    while node_id is not None:
+        path.append(node_id)
+        node_id = parents[as_key(node_id)]
+        if len(path) > len(parents):
+            raise BadInputError("Cycle detected in parent chain for %r" %
+                                leaf_id)
+    path.reverse()
+    return path
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """Split text into case-folded, accent-stripped search terms."""
+    if not text:
+        return []
+    text = unicodedata.normalize('NFKD', '%s' % text)
+    text = ''.join(x for x in text if not unicodedata.combining(x))
+
+    # str.casefold() is Python 3.3+, so fall back to lower() on Python 2
+    return _WORD_RE.findall(getattr(text, 'casefold', text.lower)())
+
+def delta_encode(values):
+    """Convert a sorted list of integers into first value plus gaps"""
+    return [y - x for x, y in zip([0] + values, values)]
+
+def delta_decode(deltas):
+    """Reverse L{delta_encode}"""
+    total, values = 0, []
+    for delta in deltas:
+        total += delta
+        values.append(total)
+    return values
+
+def search_text_index(query, index, get_shard=None):
+    """Return the sorted IDs of records containing every word in C{query}.
+
+    @param index: The output of the C{index-text} subcommand. (Its
+        C{prefix_length} determines which shard each word is in.)
+    @param get_shard: A callable which takes a shard prefix and returns the
+        C{{term: deltas}} mapping for that shard (or an empty dict).
+        Required if the index was written with C{--shard-dir}, otherwise
+        the shards embedded in C{index} are used.
+    """
+    prefix_length = index['prefix_length']
+    if get_shard is None:
+        if not isinstance(index['shards'], dict):
+            raise BadInputError("get_shard is required for an index written "
+                                "with --shard-dir")
+        get_shard = lambda x: index['shards'].get(x, {})
+
+    terms = sorted(set(tokenize(query)))
+    if not terms:
+        return []
+
+    shards, postings = {}, []
+    for term in terms:
+        prefix = term[:prefix_length]
+        if prefix not in shards:
+            shards[prefix] = get_shard(prefix)
+        if term not in shards[prefix]:
+            return []
+        postings.append(delta_decode(shards[prefix][term]))
+
+    # Intersect starting from the rarest term to keep the working set small
+    postings.sort(key=len)
+    result = set(postings[0])
+    for posting in postings[1:]:
+        result.intersection_update(posting)
+        if not result:
+            break
+    return sorted(result)
+
 def records_as_ids(records, target):
     """Generator to convert a list of records into a list of IDs."""
     for record in records:
@@ -81,6 +373,341 @@ def render_inner_single(items):
                             "more than one record: %r" % items)
     return items[0]
 
+def flatten_record(record, tag_separator):
+    """Flatten a single record in place for the C{flatten} subcommand"""
+    for key in record:
+        if isinstance(record[key], (tuple, list)):
+            record[key] = tag_separator.join(record[key])
+        elif record[key] is not None and (
+                not isinstance(record[key], (int, float, basestring))):
+            raise BadInputError("Don't know how to flatten: %r" %
+                                record[key])
+    return record
+
+# -- incremental updates --
+
+def json_key(value):
+    """Convert a value to the string JSON would use for it as a dict key"""
+    if isinstance(value, basestring):
+        return value
+    return json.dumps(value)
+
+def _unindex_record(data, record, args):
+    """Remove a record from a (JSON round-tripped) key-by/index-by result"""
+    item_id = record['id'] if args.mode == 'key-by' else record[args.target]
+    trail, container = [], data
+    for field in args.key:
+        key = json_key(record[field])
+        if key not in container:
+            raise BadInputError("Changeset doesn't match the data: no %r "
+                                "group for %r" % (key, item_id))
+        trail.append((container, key))
+        container = container[key]
+
+    parent, key = trail.pop()
+    if args.is_primary:
+        del parent[key]
+    else:
+        if args.mode == 'key-by':
+            container[:] = [x for x in container if x['id'] != item_id]
+        else:
+            # --target may not be unique and equal values are
+            # interchangeable, so remove only a single occurrence
+            if item_id not in container:
+                raise BadInputError("Changeset doesn't match the data: %r "
+                                    "not in group %r" % (item_id, key))
+            container.remove(item_id)
+        if not container:
+            del parent[key]
+
+    # Prune any nested groups which are now empty
+    while trail and not parent:
+        parent, key = trail.pop()
+        del parent[key]
+
+def _index_record(data, record, args):
+    """Add a record to a (JSON round-tripped) key-by/index-by result"""
+    if args.mode == 'key-by':
+        item, ordering = record, record_sort_key(args.sort)
+    else:
+        item, ordering = record[args.target], lambda x: (x is not None, x)
+
+    container = data
+    for field in args.key[:-1]:
+        container = container.setdefault(json_key(record[field]), {})
+    key = json_key(record[args.key[-1]])
+
+    if args.is_primary:
+        if key in container:
+            raise BadInputError("--is-primary specified but specified key "
+                                "matches more than one record: %r" % key)
+        container[key] = item
+    else:
+        group = container.setdefault(key, [])
+        group.insert(bisect_right([ordering(x) for x in group],
+                                  ordering(item)), item)
+
+def diff_records(old_records, new_records):
+    """Compare two snapshots of the records by C{id}.
+
+    @returns: A changeset dict with C{added} and C{removed} lists of records
+        and a C{changed} list of C{{'old': record, 'new': record}} pairs,
+        each sorted by ID.
+    """
+    old_by_id = dict((x['id'], x) for x in old_records)
+    new_by_id = dict((x['id'], x) for x in new_records)
+    return {
+        'added': [new_by_id[x] for x in sorted(new_by_id)
+                  if x not in old_by_id],
+        'removed': [old_by_id[x] for x in sorted(old_by_id)
+                    if x not in new_by_id],
+        'changed': [{'old': old_by_id[x], 'new': new_by_id[x]}
+                    for x in sorted(new_by_id)
+                    if x in old_by_id and old_by_id[x] != new_by_id[x]],
+    }
+
+def apply_changeset(data, changeset, args):
+    """Update the output of a previous C{key-by}, C{index-by}, C{flatten}, or
+    C{visjs} run in place, touching only the affected groups and entries.
+
+    C{args} must match the options used to produce C{data}, with C{mode}
+    naming the subcommand. C{data} is assumed to have been loaded from JSON.
+    """
+    old = changeset['removed'] + [x['old'] for x in changeset['changed']]
+    new = changeset['added'] + [x['new'] for x in changeset['changed']]
+
+    if args.mode in ('key-by', 'index-by'):
+        if not args.key:
+            raise BadInputError("Must specify the key fields to update "
+                                "%s output" % args.mode)
+        if args.mode == 'index-by' and args.sort != [args.target]:
+            raise BadInputError("Can only update index-by output sorted by "
+                                "its --target field")
+        for record in old:
+            _unindex_record(data, record, args)
+        for record in new:
+            _index_record(data, dict(record), args)
+    elif args.mode == 'flatten':
+        stale = set(x['id'] for x in old)
+        data[:] = [x for x in data if x['id'] not in stale]
+        ordering = record_sort_key(args.sort)
+        keys = [ordering(x) for x in data]
+        for record in new:
+            record = flatten_record(dict(record), args.tag_separator)
+            offset = bisect_right(keys, ordering(record))
+            keys.insert(offset, ordering(record))
+            data.insert(offset, record)
+    elif args.mode == 'visjs':
+        graph = data['entries'] if 'collapsed_on' in data else data
+        stale = set(x['id'] for x in old)
+        positioned = any('x' in x for x in graph['nodes'])
+
+        graph['nodes'][:] = [x for x in graph['nodes'] if x['id'] not in stale]
+        graph['edges'][:] = [x for x in graph['edges'] if x['to'] not in stale]
+        added = make_graph([dict(x) for x in new], args.label_field)
+        graph['nodes'].extend(added['nodes'])
+        graph['edges'].extend(added['edges'])
+
+        # A new or moved episode can shift every row below it
+        if positioned and (old or new):
+            layout_tree(graph['nodes'])
+    else:
+        raise BadInputError("Don't know how to update %r output" % args.mode)
+    return data
+
+# -- random-access record store --
+
+RECORD_STORE_MAGIC = b'AVIX'
+RECORD_STORE_VERSION = 1
+_STORE_HEADER = struct.Struct(str('<4sII'))  # magic, version, entry count
+_STORE_ENTRY = struct.Struct(str('<qQI'))    # id, offset, length
+
+def write_record_store(records, prefix):
+    """Write records to C{PREFIX.jsonl} (one per line) and a sorted binary
+    C{(id, offset, length)} index to C{PREFIX.idx} for L{RecordStore}.
+
+    @returns: The number of records written.
+    """
+    entries, offset = [], 0
+    with open(prefix + '.jsonl', 'wb') as data_file:
+        for record in records:
+            line = (json.dumps(record) + '\n').encode('utf-8')
+            data_file.write(line)
+            entries.append((record['id'], offset, len(line)))
+            offset += len(line)
+
+    entries.sort()
+    for prev, entry in zip(entries, entries[1:]):
+        if prev[0] == entry[0]:
+            raise BadInputError("Record store IDs must be unique: %r" %
+                                entry[0])
+
+    with open(prefix + '.idx', 'wb') as index_file:
+        index_file.write(_STORE_HEADER.pack(
+            RECORD_STORE_MAGIC, RECORD_STORE_VERSION, len(entries)))
+        for entry in entries:
+            index_file.write(_STORE_ENTRY.pack(*entry))
+    return len(entries)
+
+class RecordStore(object):
+    """Random access to the output of L{write_record_store} by record ID.
+
+    The index is memory-mapped and binary-searched, so each lookup only
+    reads and parses the one line it needs.
+
+    IDs may be given as integers or as strings (eg. from a query string).
+    Anything else, including bools and non-integral numbers, is treated as
+    a missing record.
+    """
+    def __init__(self, prefix):
+        with open(prefix + '.idx', 'rb') as index_file:
+            try:
+                self._index = mmap.mmap(index_file.fileno(), 0,
+                                        access=mmap.ACCESS_READ)
+            except ValueError:  # Can't map an empty file
+                raise BadInputError("Truncated record store index: %s.idx" %
+                                    prefix)
+        try:
+            self._data = open(prefix + '.jsonl', 'rb')
+        except:  # noqa
+            self._index.close()
+            raise
+
+        if len(self._index) < _STORE_HEADER.size:
+            self.close()
+            raise BadInputError("Truncated record store index: %s.idx" %
+                                prefix)
+        magic, version, self._count = _STORE_HEADER.unpack_from(self._index)
+        if magic != RECORD_STORE_MAGIC or version != RECORD_STORE_VERSION:
+            self.close()
+            raise BadInputError("Not a version %d record store index: %s.idx"
+                                % (RECORD_STORE_VERSION, prefix))
+        if len(self._index) != (_STORE_HEADER.size +
+                                self._count * _STORE_ENTRY.size):
+            self.close()
+            raise BadInputError("Truncated record store index: %s.idx" %
+                                prefix)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, record_id):
+        return self._find(record_id) is not None
+
+    def __getitem__(self, record_id):
+        entry = self._find(record_id)
+        if entry is None:
+            raise KeyError(record_id)
+        return self._read(entry)
+
+    def get(self, record_id, default=None):
+        """Return the record with the given ID, or C{default}"""
+        entry = self._find(record_id)
+        return default if entry is None else self._read(entry)
+
+    def get_many(self, record_ids):
+        """Look up several records, reading them in file order.
+
+        @returns: A dict mapping each ID found to its record.
+        """
+        entries = [self._find(x) for x in set(record_ids)]
+        entries = sorted((x for x in entries if x is not None),
+                         key=lambda x: x[1])
+        return dict((x[0], self._read(x)) for x in entries)
+
+    def close(self):
+        """Release the index mapping and data file"""
+        self._index.close()
+        self._data.close()
+
+    def _find(self, record_id):
+        """Binary search the index for the C{(id, offset, length)} entry"""
+        if isinstance(record_id, basestring):
+            try:
+                record_id = int(record_id)
+            except ValueError:
+                return None
+        elif isinstance(record_id, bool) or not isinstance(
+                record_id, numbers.Integral):
+            return None
+
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            entry = _STORE_ENTRY.unpack_from(
+                self._index, _STORE_HEADER.size + mid * _STORE_ENTRY.size)
+            if entry[0] < record_id:
+                low = mid + 1
+            elif entry[0] > record_id:
+                high = mid
+            else:
+                return entry
+        return None
+
+    def _read(self, entry):
+        """Read and decode the line referenced by an index entry"""
+        self._data.seek(entry[1])
+        return json.loads(self._data.read(entry[2]).decode('utf-8'))
+
+# -- statistics --
+
+def _import_numpy():
+    """Return the numpy module if installed, otherwise None"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def count_months(posted):
+    """Histogram a list of UNIX timestamps by UTC C{YYYY-MM}"""
+    numpy = _import_numpy()
+    if numpy is None:
+        return Counter(time.strftime('%Y-%m', time.gmtime(x))
+                       for x in posted)
+
+    months = numpy.floor(numpy.array(posted, dtype='float64')).astype(
+        'int64').astype('datetime64[s]').astype('datetime64[M]')
+    keys, counts = numpy.unique(months, return_counts=True)
+    return dict(('%s' % x, int(y)) for x, y in zip(keys, counts))
+
+def count_branching(parent_ids):
+    """Histogram how many records have each number of children.
+
+    As with L{build_tree}, links to parents outside the data set are ignored.
+    """
+    numpy = _import_numpy()
+    if numpy is None:
+        child_counts = Counter(x for x in parent_ids.values()
+                               if x in parent_ids)
+        result = Counter(child_counts.values())
+    else:
+        ids = numpy.fromiter(parent_ids.keys(), dtype='int64',
+                             count=len(parent_ids))
+        parents = numpy.fromiter((-1 if x is None else x
+                                  for x in parent_ids.values()),
+                                 dtype='int64', count=len(parent_ids))
+        parents = parents[numpy.isin(parents, ids)]
+        child_counts = numpy.unique(parents, return_counts=True)[1]
+        keys, counts = numpy.unique(child_counts, return_counts=True)
+        result = Counter(dict((int(x), int(y)) for x, y in zip(keys, counts)))
+
+    leaves = len(parent_ids) - sum(result.values())
+    if leaves:
+        result[0] = leaves
+    return result
+
+def _sorted_counts(counter):
+    """Order a histogram by key (with C{None} first) for readable output"""
+    return dict(sorted(counter.items(),
+                       key=lambda x: (x[0] is not None, x[0])))
+
 # -- subcommands --
 
 def key_by(records, args):
@@ -90,7 +717,7 @@ def key_by(records, args):
     else:
         render_inner = lambda x: list(x)  # noqa
     return dict(group_by_multiple(records, args.key, render_inner,
-                                  list_ordering=lambda x: x[args.sort]))
+                                  list_ordering=record_sort_key(args.sort)))
 
 def index_by(records, args):
     """The C{index-by} subcommand"""
@@ -100,33 +727,151 @@ def index_by(records, args):
     else:
         render_inner = lambda x: list(records_as_ids(x, args.target))  # noqa
     return dict(group_by_multiple(records, args.key, render_inner,
-                                  list_ordering=lambda x: x[args.sort] or ''))
+                                  list_ordering=sort_key(args.sort)))
 
 def flatten(records, args):
     """The C{flatten} subcommand"""
+    return external_sort((flatten_record(x, args.tag_separator)
+                          for x in records), record_sort_key(args.sort),
+                         args.max_in_memory)
+
+def paths(records, args):  # pylint: disable=unused-argument
+    """The C{paths} subcommand"""
+    parent_ids = dict((x['id'], x['parent_id']) for x in records)
+    children, roots = build_tree(parent_ids)
+
+    parents, leaves, branch_points = {}, [], []
+    longest = (-1, None)
+    for node_id, depth in walk_tree(children, roots):
+        # Orphans become roots so their chains still terminate
+        parents[node_id] = parent_ids[node_id] if depth else None
+
+        child_count = len(children.get(node_id, ()))
+        if not child_count:
+            leaves.append(node_id)
+            if depth > longest[0]:
+                longest = (depth, node_id)
+        elif child_count > 1:
+            branch_points.append(node_id)
+
+    if len(parents) < len(parent_ids):
+        log.warning("Omitting %d records which are part of parent_id cycles",
+                    len(parent_ids) - len(parents))
+
+    leaves.sort()
+    branch_points.sort()
+    return {
+        'parents': parents,
+        'leaves': leaves,
+        'branch_points': branch_points,
+        'longest_path': story_path(parents, longest[1]) if leaves else [],
+        'stats': {
+            'roots': len(roots),
+            'leaves': len(leaves),
+            'branch_points': len(branch_points),
+            'longest_path_length': longest[0] + 1,
+        }
+    }
+
+def index_text(records, args):
+    """The C{index-text} subcommand"""
+    postings = {}
     for record in records:
-        for key in record:
-            if isinstance(record[key], (tuple, list)):
-                record[key] = args.tag_separator.join(record[key])
-            elif record[key] is not None and (
-                    not isinstance(record[key], (int, float, basestring))):
-                raise BadInputError("Don't know how to flatten: %r" %
-                                    record[key])
-    records.sort(key=lambda x: x[args.sort])
-    return records
+        for field in args.fields:
+            for term in tokenize(record.get(field)):
+                postings.setdefault(term, set()).add(record['id'])
+
+    shards = {}
+    for term, ids in postings.items():
+        shards.setdefault(term[:args.prefix_length], {})[term] = (
+            delta_encode(sorted(ids)))
+
+    result = {
+        'fields': args.fields,
+        'prefix_length': args.prefix_length,
+        'terms': len(postings),
+    }
+
+    if not args.shard_dir:
+        result['shards'] = shards
+        return result
+
+    if not os.path.isdir(args.shard_dir):
+        os.makedirs(args.shard_dir)
+    for prefix, shard in shards.items():
+        path = os.path.join(args.shard_dir, '%s.%s' % (prefix, args.format))
+        with open(path, 'w') as fobj:
+            OUTPUT_FORMATS[args.format](shard, fobj)
+    result['shards'] = sorted(shards)
+    return result
+
+def diff(records, args):
+    """The C{diff} subcommand"""
+    old_records = list(iter_records(args.old))
+    args.old.close()
+    return diff_records(old_records, records)
+
+def apply_diff(records, args):
+    """The C{apply-diff} subcommand"""
+    changeset = json.load(args.changeset)
+    args.changeset.close()
+    return apply_changeset(records, changeset, args)
+
+def stats(records, args):
+    """The C{stats} subcommand"""
+    authors, threads, tags = Counter(), Counter(), Counter()
+    parent_ids, posted = {}, []
+    for record in records:
+        authors[record['author']] += 1
+        threads[record['thread']] += 1
+        tags.update(record['tags'])
+        parent_ids[record['id']] = record['parent_id']
+        if record.get('posted') is not None:
+            posted.append(record['posted'])
+
+    children, roots = build_tree(parent_ids)
+    depths = Counter(x[1] for x in walk_tree(children, roots))
+
+    result = {
+        'records': len(parent_ids),
+        'authors': _sorted_counts(authors),
+        'threads': _sorted_counts(threads),
+        'tags': _sorted_counts(tags),
+        'posted_by_month': _sorted_counts(count_months(posted)),
+        'branching_factor': _sorted_counts(count_branching(parent_ids)),
+        'depth': _sorted_counts(depths),
+    }
+    if not args.as_rows:
+        return result
+
+    rows = [{'statistic': 'records', 'value': None,
+             'count': result.pop('records')}]
+    for name in sorted(result):
+        rows.extend({'statistic': name, 'value': key, 'count': count}
+                    for key, count in result[name].items())
+    return rows
+
+def record_store(records, args):
+    """The C{record-store} subcommand"""
+    count = write_record_store(records, args.prefix)
+    return {
+        'records': count,
+        'data': args.prefix + '.jsonl',
+        'index': args.prefix + '.idx',
+    }
 
 def visjs(records, args):
     """The C{visjs} subcommand"""
     if args.multilevel:
         result = {
             'collapsed_on': args.multilevel,
-            'entries': make_graph(records, args.label_field),
+            'entries': make_graph(records, args.label_field, args.layout),
         }
 
         # TODO: Generate the threads graph
         return result
     else:
-        return make_graph(records, args.label_field)
+        return make_graph(records, args.label_field, args.layout)
 
 # -- output serializers --
 
@@ -137,14 +882,31 @@ def factory_dump_csv(dialect):
 
         @returns: C{tuple(data, file_extension)}
         """
+        expected = None
         try:
-            columns = list(set(chain.from_iterable(x.keys() for x in records)))
+            if isinstance(records, list):
+                columns = list(set(chain.from_iterable(
+                    x.keys() for x in records)))
+            else:
+                # Streamed input can't be scanned in advance, so require
+                # every record to have the same fields as the first
+                records = iter(records)
+                first = next(records, None)
+                columns = list(first.keys()) if first else []
+                expected = set(columns)
+                records = chain([first] if first else [], records)
         except AttributeError:
             raise BadInputError("Must flatten data to generate CSV/TSV output")
 
         writer = csv.writer(file_obj, dialect=dialect)
         writer.writerow(columns)
         for record in records:
+            if not isinstance(record, dict):
+                raise BadInputError("Must flatten data to generate CSV/TSV "
+                                    "output")
+            if expected is not None and set(record) != expected:
+                raise BadInputError("Streamed record doesn't have the same "
+                                    "fields as the first one: %r" % record)
             writer.writerow([record.get(x, None) for x in columns])
     return dump_csv
 
@@ -210,9 +972,10 @@ def main():
     parser.add_argument('-o', '--outfile', action="store", type=FileType('w'),
                         default='-', help="specify the json file to read from "
                         "(default is '-', outputting to stdout)")
-    parser.add_argument('-s', '--sort', action="store", default='id',
-                        help="specify the key to sort data by")
-    # TODO: Support specifying multiple times to sort by a composite key
+    parser.add_argument('-s', '--sort', action="append", default=None,
+                        help="specify the key to sort data by. Specify "
+                        "multiple times to sort by a composite key. "
+                        "(default: id)")
 
     subparsers = parser.add_subparsers(
         description='Operations this tool can perform')
@@ -241,7 +1004,30 @@ def main():
     parser_flatten.add_argument('--tag-separator', action="store",
         default='|', help="Specify the character to be used when flattening"
         "the 'tags' sublist into a string (default: %(default)s )")
-    parser_flatten.set_defaults(func=flatten)
+    parser_flatten.add_argument('--max-in-memory', action="store", type=int,
+        default=100000, help="Specify how many records to sort in memory "
+        "before spilling sorted runs to temporary files "
+        "(default: %(default)s)")
+    parser_flatten.set_defaults(func=flatten, streaming=True)
+
+    parser_paths = subparsers.add_parser('paths', help='Extract every '
+        'root-to-leaf reading chain as a compact "parent pointers plus list '
+        'of leaves" structure, along with branching statistics.')
+    parser_paths.set_defaults(func=paths)
+
+    parser_index_text = subparsers.add_parser('index-text', help='Produce an '
+        'inverted index mapping normalized words to delta-encoded lists of '
+        'record IDs, sharded by word prefix.')
+    parser_index_text.add_argument('fields', nargs='*', default=['title'],
+        help="Specify which fields to index (default: title)")
+    parser_index_text.add_argument('--prefix-length', action="store",
+        type=int, default=2, help="Specify how many leading characters of "
+        "each word determine its shard (default: %(default)s)")
+    parser_index_text.add_argument('--shard-dir', action="store",
+        default=None, help="Write each shard to its own file in this "
+        "directory so clients need only fetch the one they're searching. "
+        "The main output then contains only the list of shards.")
+    parser_index_text.set_defaults(func=index_text)
 
     parser_visjs = subparsers.add_parser('visjs', help='Reorganize the data '
         'into the "list of nodes and list of edges, with each node having '
@@ -253,9 +1039,58 @@ def main():
         default=False, help="Allow the visualization of the entire Addventure "
         "by generating the data for a top-level graph of groups and a "
         "separate graph for each group.")
+    parser_visjs.add_argument('--layout', action="store_true",
+        default=False, help="Precompute a deterministic tree layout and "
+        "store it in each node's x and y fields so the browser doesn't need "
+        "to lay out the graph itself.")
     parser_visjs.set_defaults(func=visjs)
 
+    parser_stats = subparsers.add_parser('stats', help='Compute per-author, '
+        'per-thread, and per-tag episode counts, plus histograms of posting '
+        'activity by month, branching factor, and depth, in a single pass. '
+        'Uses NumPy, if installed, to speed up the numeric histograms.')
+    parser_stats.add_argument('--as-rows', action="store_true",
+        default=False, help="Output a list of (statistic, value, count) "
+        "records suitable for CSV/TSV output instead of nested dicts.")
+    parser_stats.set_defaults(func=stats, streaming=True)
+
+    parser_record_store = subparsers.add_parser('record-store', help='Write '
+        'one record per line to PREFIX.jsonl, plus a sorted binary ID index '
+        'to PREFIX.idx, so RecordStore can look up single records without '
+        'loading everything.')
+    parser_record_store.add_argument('prefix',
+        help="The path to write the files to, minus the extension")
+    parser_record_store.set_defaults(func=record_store, streaming=True)
+
+    parser_diff = subparsers.add_parser('diff', help='Compare the input '
+        'against an older snapshot and produce a changeset listing added, '
+        'removed, and changed records.')
+    parser_diff.add_argument('old', type=FileType('r'),
+        help="The older JSON file to compare against")
+    parser_diff.set_defaults(func=diff)
+
+    parser_apply_diff = subparsers.add_parser('apply-diff', help='Update '
+        'the JSON output of a previous key-by, index-by, flatten, or visjs '
+        'run (given as the input file) using a changeset from diff.')
+    parser_apply_diff.add_argument('changeset', type=FileType('r'),
+        help="The JSON changeset produced by the diff subcommand")
+    parser_apply_diff.add_argument('mode',
+        choices=['key-by', 'index-by', 'flatten', 'visjs'],
+        help="The subcommand which produced the input file")
+    parser_apply_diff.add_argument('key', nargs='*',
+        help="The key fields originally passed to key-by or index-by")
+    parser_apply_diff.add_argument('--target', action="store", default='id',
+        help="As for index-by (default: %(default)s)")
+    parser_apply_diff.add_argument('--is-primary', action="store_true",
+        default=False, help="As for key-by and index-by")
+    parser_apply_diff.add_argument('--tag-separator', action="store",
+        default='|', help="As for flatten (default: %(default)s )")
+    parser_apply_diff.add_argument('--label-field', action="store",
+        default='title', help="As for visjs (default: %(default)s)")
+    parser_apply_diff.set_defaults(func=apply_diff, derived_input=True)
+
     args = parser.parse_args()
+    args.sort = args.sort or ['id']
 
     # Set up clean logging to stderr
     log_levels = [logging.CRITICAL, logging.ERROR, logging.WARNING,
@@ -266,15 +1101,23 @@ def main():
                         format='%(levelname)s: %(message)s')
 
     # Load data
-    records = json.load(args.infile)
-    args.infile.close()
-    log.debug("Loaded %d records", len(records))
+    if getattr(args, 'derived_input', False):
+        records = json.load(args.infile)
+    else:
+        records = iter_records(args.infile)
+        if not getattr(args, 'streaming', False):
+            records = list(records)
+            log.debug("Loaded %d records", len(records))
 
     # Process data
     data = args.func(records, args)
 
-    # Save data
+    # Save data (Only the CSV/TSV serializers can consume data as a stream)
+    if args.format not in ('csv', 'tsv') and not isinstance(data,
+                                                            (dict, list)):
+        data = list(data)
     OUTPUT_FORMATS[args.format](data, args.outfile)
+    args.infile.close()
     args.outfile.close()
 
 if __name__ == '__main__':
@@ -12,6 +12,7 @@ __author__ = "Stephan Sokolow (deitarion/SSokolow)"
 __license__ = "MIT"
 
 from nose.tools import assert_raises, eq_
+import copy, json, os, shutil, tempfile
 import prepare_metadata
 
 test_data = [
@@ -58,7 +59,7 @@ class MockArgs(object):  # pylint: disable=too-few-public-methods
     is_primary = False
     target = 'id'
     key = ['thread']
-    sort = 'id'
+    sort = ['id']
 
 def test_records_as_ids():
     """records_as_ids: basic function"""
@@ -98,4 +99,321 @@ def test_key_by():
     eq_(prepare_metadata.key_by(test_data, MockArgs), expected)
     # TODO: More tests for other modes of operation
 
+def test_paths():
+    """paths: basic function"""
+    result = prepare_metadata.paths(test_data, MockArgs)
+    eq_(result['leaves'], [3, 4])
+    eq_(result['branch_points'], [1])
+    eq_(result['longest_path'], [1, 2, 4])
+    eq_(result['stats'], {'roots': 1, 'leaves': 2, 'branch_points': 1,
+                          'longest_path_length': 3})
+
+    for leaf in result['leaves']:
+        path = prepare_metadata.story_path(result['parents'], leaf)
+        eq_(path[0], 1)
+        eq_(path[-1], leaf)
+
+def test_paths_deep_chain():
+    """paths: chains deeper than the recursion limit"""
+    depth = 5000
+    records = [{'id': x, 'parent_id': x - 1 if x else None}
+               for x in range(depth)]
+    result = prepare_metadata.paths(records, MockArgs)
+    eq_(result['leaves'], [depth - 1])
+    eq_(result['longest_path'], list(range(depth)))
+
+    # Make sure a JSON round-trip doesn't break path reconstruction
+    parents = dict(('%s' % k, v) for k, v in result['parents'].items())
+    eq_(prepare_metadata.story_path(parents, depth - 1), list(range(depth)))
+
+def test_story_path_missing():
+    """story_path: IDs which aren't in the parents mapping"""
+    story_path = prepare_metadata.story_path
+    assert_raises(KeyError, story_path, {1: None, 2: 1}, 99)
+    assert_raises(KeyError, story_path, {'1': None, '2': 1}, 99)
+    assert_raises(KeyError, story_path, {}, 1)
+
+def test_tokenize():
+    """tokenize: case folding, accent stripping, and punctuation"""
+    eq_(prepare_metadata.tokenize("Café au Lait, part 2!"),
+        ['cafe', 'au', 'lait', 'part', '2'])
+    eq_(prepare_metadata.tokenize(None), [])
+    if hasattr('', 'casefold'):
+        eq_(prepare_metadata.tokenize("STRASSE straße"), ['strasse'] * 2)
+
+def test_delta_encode():
+    """delta_encode/delta_decode: round-trip"""
+    eq_(prepare_metadata.delta_encode([3, 5, 6, 10]), [3, 2, 1, 4])
+    eq_(prepare_metadata.delta_decode([3, 2, 1, 4]), [3, 5, 6, 10])
+
+def test_index_text():
+    """index_text: basic function and querying"""
+    class Args(MockArgs):  # pylint: disable=too-few-public-methods
+        """Arguments for index-text"""
+        fields = ['title', 'thread']
+        prefix_length = 2
+        shard_dir = None
+
+    index = prepare_metadata.index_text(test_data, Args)
+    eq_(index['shards']['te']['test'], [1, 1, 1, 1])
+    eq_(index['shards']['da']['dark'], [2, 2])
+
+    search = prepare_metadata.search_text_index
+    eq_(search("test TITLE", index), [1, 2, 3, 4])
+    eq_(search("title dark", index), [2, 4])
+    eq_(search("title 3", index), [3])
+    eq_(search("dark 3", index), [])
+    eq_(search("nonexistent", index), [])
+    eq_(search("", index), [])
+
+    # The prefix length must come from the index itself
+    Args.prefix_length = 3
+    index = prepare_metadata.index_text(test_data, Args)
+    eq_(search("title dark", index), [2, 4])
+    eq_(search("title dark", {'prefix_length': 3, 'shards': ['tit']},
+               lambda x: index['shards'].get(x, {})), [2, 4])
+    assert_raises(prepare_metadata.BadInputError, search, "title",
+                  {'prefix_length': 3, 'shards': ['tit']})
+
+def test_layout_tree():
+    """layout_tree: basic function"""
+    records = [{'id': x['id'], 'parent_id': x['parent_id']}
+               for x in test_data]
+    records.append({'id': 5, 'parent_id': None})
+    prepare_metadata.layout_tree(records, level_separation=10,
+                                 node_spacing=1)
+    eq_(dict((x['id'], (x['x'], x['y'])) for x in records), {
+        1: (0, 0.5),
+        2: (10, 0),
+        3: (10, 1),
+        4: (20, 0),
+        5: (0, 3),
+    })
+
+    # Records in a parent_id cycle can't be reached from a root
+    records.extend([{'id': 6, 'parent_id': 7}, {'id': 7, 'parent_id': 6}])
+    prepare_metadata.layout_tree(records, level_separation=10,
+                                 node_spacing=1)
+    eq_(dict((x['id'], (x['x'], x['y'])) for x in records[-2:]),
+        {6: (0, 5), 7: (0, 6)})
+
+def test_diff_records():
+    """diff_records: basic function"""
+    new_data = copy.deepcopy(test_data[1:])
+    new_data[0]['title'] = 'Changed title'
+    new_data.append({'id': 5, 'parent_id': 3})
+
+    eq_(prepare_metadata.diff_records(test_data, new_data), {
+        'added': [{'id': 5, 'parent_id': 3}],
+        'removed': [test_data[0]],
+        'changed': [{'old': test_data[1], 'new': new_data[0]}],
+    })
+    eq_(prepare_metadata.diff_records(test_data, test_data),
+        {'added': [], 'removed': [], 'changed': []})
+
+def check_apply_changeset(mode, func, **kwargs):
+    """Check that apply_changeset matches a full rebuild"""
+    class Args(MockArgs):  # pylint: disable=too-few-public-methods
+        """Arguments for the subcommand and apply_changeset"""
+        tag_separator = '|'
+        label_field = 'title'
+        multilevel = False
+        layout = True
+        max_in_memory = 2
+    Args.mode = mode
+    for name, value in kwargs.items():
+        setattr(Args, name, value)
+
+    old_data = copy.deepcopy(test_data)
+    new_data = copy.deepcopy(test_data)
+    new_data[1]['thread'] = 'Renamed thread'
+    new_data[3]['title'] = 'Changed title'
+    del new_data[2]
+    new_data.append({'id': 5, 'parent_id': 4, 'title': 'Test title 5',
+                     'author': 'author 1', 'author_email': None,
+                     'tags': ['dark'], 'thread': None})
+    changeset = json.loads(json.dumps(
+        prepare_metadata.diff_records(old_data, new_data)))
+
+    # Simulate loading the output of a previous run
+    derived = func(copy.deepcopy(old_data), Args)
+    expected = func(copy.deepcopy(new_data), Args)
+    if mode == 'flatten':
+        derived, expected = list(derived), list(expected)
+    derived = json.loads(json.dumps(derived))
+    expected = json.loads(json.dumps(expected))
+    result = prepare_metadata.apply_changeset(derived, changeset, Args)
+
+    if mode == 'visjs':
+        for graph in (result, expected):
+            graph['nodes'].sort(key=lambda x: x['id'])
+            graph['edges'].sort(key=lambda x: x['to'])
+    eq_(result, expected)
+
+def test_apply_changeset():
+    """apply_changeset: matches a full rebuild"""
+    check_apply_changeset('key-by', prepare_metadata.key_by)
+    check_apply_changeset('key-by', prepare_metadata.key_by,
+                          key=['author', 'thread'])
+    check_apply_changeset('key-by', prepare_metadata.key_by,
+                          key=['id'], is_primary=True)
+    check_apply_changeset('index-by', prepare_metadata.index_by)
+    check_apply_changeset('index-by', prepare_metadata.index_by,
+                          key=['thread', 'author'])
+    check_apply_changeset('index-by', prepare_metadata.index_by,
+                          key=['author'], target='thread', sort=['thread'])
+    check_apply_changeset('flatten', prepare_metadata.flatten)
+    check_apply_changeset('flatten', prepare_metadata.flatten,
+                          sort=['author'])
+    check_apply_changeset('key-by', prepare_metadata.key_by,
+                          key=['thread'], sort=['author'])
+    check_apply_changeset('visjs', prepare_metadata.visjs)
+
+def test_sort_key():
+    """sort_key: composite keys and None handling"""
+    records = sorted(test_data, key=prepare_metadata.sort_key(
+        ['thread', 'author', 'id']))
+    eq_([x['id'] for x in records], [1, 3, 2, 4])
+
+    records = sorted(test_data, key=prepare_metadata.sort_key(
+        ['author', 'parent_id']))
+    eq_([x['id'] for x in records], [1, 3, 2, 4])
+
+def test_external_sort():
+    """external_sort: matches an in-memory stable sort"""
+    records = [{'id': x, 'group': (x * 7) % 5} for x in range(50)]
+    key = prepare_metadata.sort_key(['group'])
+    expected = sorted(records, key=key)
+
+    for max_in_memory in (3, 50, 100):
+        eq_(list(prepare_metadata.external_sort(
+            iter(records), key, max_in_memory)), expected)
+
+    # Exercise the tiered merging which bounds the number of open files
+    for merge_width in (2, 3):
+        eq_(list(prepare_metadata.external_sort(
+            iter(records), key, 1, merge_width)), expected)
+    eq_(list(prepare_metadata.external_sort([], key, 3)), [])
+
+    # Input which fits in a single run is returned as a plain list
+    assert isinstance(prepare_metadata.external_sort(records, key, 50), list)
+    assert not isinstance(prepare_metadata.external_sort(records, key, 49),
+                          list)
+
+def test_flatten_mixed_schema():
+    """flatten: CSV output of records with differing fields"""
+    from io import StringIO
+
+    class Args(MockArgs):  # pylint: disable=too-few-public-methods
+        """Arguments for flatten"""
+        tag_separator = '|'
+        max_in_memory = 100
+
+    records = sorted(copy.deepcopy(test_data), key=lambda x: x['id'])
+    records[0]['posted'] = 1201866660.0
+    records[1]['extra'] = 'value'
+    dump_csv = prepare_metadata.OUTPUT_FORMATS['csv']
+
+    # Fully-loaded input uses the union of all fields as its columns
+    out_file = StringIO()
+    dump_csv(prepare_metadata.flatten(records, Args), out_file)
+    rows = out_file.getvalue().splitlines()
+    eq_(len(rows), 5)
+    assert 'posted' in rows[0] and 'extra' in rows[0]
+    assert 'value' in rows[2]
+
+    # Streamed input can't be scanned ahead, so mismatches must be reported
+    assert_raises(prepare_metadata.BadInputError, dump_csv,
+                  iter(records), StringIO())
+
+def test_iter_records():
+    """iter_records: JSON and JSON Lines input"""
+    from io import StringIO
+    json_data = json.dumps(test_data, indent=2)
+    jsonl_data = '\n'.join(json.dumps(x) for x in test_data) + '\n\n'
+    for data in (json_data, jsonl_data, '\n' + jsonl_data):
+        eq_(list(prepare_metadata.iter_records(StringIO(data))), test_data)
+    eq_(list(prepare_metadata.iter_records(StringIO(''))), [])
+
+def test_stats():
+    """stats: basic function"""
+    class Args(MockArgs):  # pylint: disable=too-few-public-methods
+        """Arguments for stats"""
+        as_rows = False
+
+    records = copy.deepcopy(test_data)
+    records[0]['posted'] = 1201866660.0  # 2008-02-01
+    records[1]['posted'] = 1204329600.0  # 2008-03-01 00:00:00
+    records[2]['posted'] = 1204329599.0  # 2008-02-29 23:59:59
+
+    result = prepare_metadata.stats(iter(records), Args)
+    eq_(result, {
+        'records': 4,
+        'authors': {'author 1': 2, 'author 2': 1, 'author 3': 1},
+        'threads': {None: 2, 'Well, that got dark quickly': 2},
+        'tags': {'dark': 2, 'lime': 1, 'waff': 1},
+        'posted_by_month': {'2008-02': 2, '2008-03': 1},
+        'branching_factor': {0: 2, 1: 1, 2: 1},
+        'depth': {0: 1, 1: 2, 2: 1},
+    })
+
+    Args.as_rows = True
+    rows = prepare_metadata.stats(iter(records), Args)
+    eq_(rows[0], {'statistic': 'records', 'value': None, 'count': 4})
+    assert {'statistic': 'depth', 'value': 2, 'count': 1} in rows
+
+def test_record_store():
+    """RecordStore: write and look up records"""
+    tmp_dir = tempfile.mkdtemp()
+    prefix = os.path.join(tmp_dir, 'store')
+    try:
+        records = list(reversed(test_data))
+        eq_(prepare_metadata.write_record_store(iter(records), prefix), 4)
+
+        with prepare_metadata.RecordStore(prefix) as store:
+            eq_(len(store), 4)
+            for record in test_data:
+                eq_(store[record['id']], record)
+            assert 3 in store
+            assert 5 not in store
+            eq_(store.get(0), None)
+            assert_raises(KeyError, lambda: store[99])
+            eq_(store.get_many([4, 1, 99, 1]),
+                {1: test_data[0], 4: test_data[3]})
+
+            # IDs from query strings and the like arrive as strings
+            eq_(store['3'], store[3])
+            eq_(store.get('bogus'), None)
+            assert None not in store
+            assert_raises(KeyError, lambda: store['1.5'])
+
+            # Never truncate non-integral IDs into the wrong record
+            assert_raises(KeyError, lambda: store[1.5])
+            assert_raises(KeyError, lambda: store[True])
+            assert 2.7 not in store
+
+        # A missing data file mustn't leave the index mapped
+        os.rename(prefix + '.jsonl', prefix + '.moved')
+        assert_raises(IOError, prepare_metadata.RecordStore, prefix)
+        os.rename(prefix + '.moved', prefix + '.jsonl')
+
+        # Truncated or empty indexes are reported cleanly
+        shutil.copy(prefix + '.idx', prefix + '.idx.bak')
+        for size in (0, 3):
+            with open(prefix + '.idx', 'r+b') as fobj:
+                fobj.truncate(size)
+            assert_raises(prepare_metadata.BadInputError,
+                          prepare_metadata.RecordStore, prefix)
+        os.rename(prefix + '.idx.bak', prefix + '.idx')
+
+        # The data file doubles as streamable JSON Lines input
+        with open(prefix + '.jsonl') as fobj:
+            eq_(list(prepare_metadata.iter_records(fobj)), records)
+
+        assert_raises(prepare_metadata.BadInputError,
+                      prepare_metadata.write_record_store,
+                      test_data + test_data[:1], prefix)
+    finally:
+        shutil.rmtree(tmp_dir)
+
 # vim: set sw=4 sts=4 expandtab :